@@ -1,13 +1,48 @@
 # scripts/reset_test_project.py
+import asyncio
+import contextvars
+import math
 import subprocess
 import os
 import argparse
 import sys
+import time
 
 # Define the explicit path to the Git executable
 GIT_EXECUTABLE = r"C:\Program Files\Git\cmd\git.exe" # Use raw string for Windows path
 
-def run_command(cmd, cwd):
+# Stay under the 32K-character CreateProcess command-line limit on Windows
+MAX_COMMAND_LINE = 30000
+
+# Skip fetching origin again if FETCH_HEAD is younger than this many seconds
+# (overridden by the RESET_FETCH_TTL environment variable when run as a script)
+FETCH_TTL = 60.0
+
+class GitNotFoundError(Exception):
+    """Raised when GIT_EXECUTABLE can't be started."""
+
+# Set per repository while several are reset at once, so their interleaved output can be told apart
+_log_prefix = contextvars.ContextVar("log_prefix", default="")
+
+def log(message="", file=None):
+    """Prints a message, prefixing each line with the current repository when several run concurrently."""
+    prefix = _log_prefix.get()
+    text = str(message)
+    if prefix:
+        text = "\n".join(f"{prefix}{line}" for line in text.splitlines() or [""])
+    print(text, file=file or sys.stdout)
+
+async def run_process(cmd, cwd):
+    """Runs a command without blocking the event loop and returns a CompletedProcess with raw bytes output."""
+    proc = await asyncio.create_subprocess_exec(*cmd, cwd=cwd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await proc.communicate()
+    return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+
+def decode_output(data):
+    """Decodes git output for printing, without failing on bytes that aren't valid UTF-8."""
+    return data.decode('utf-8', 'replace')
+
+async def run_command_async(cmd, cwd):
     """Runs a command in a subprocess and handles errors, using the full Git path."""
 
     # Replace 'git' command with the full path if it's the command being run
@@ -15,163 +50,300 @@ def run_command(cmd, cwd):
     if cmd[0] == 'git':
         cmd = [GIT_EXECUTABLE] + cmd[1:]
 
-    print(f"Running in {cwd}: {' '.join(cmd)}")
+    log(f"Running in {cwd}: {' '.join(cmd)}")
     try:
-        # Use shell=False (default) now that we have the full path
-        result = subprocess.run(cmd, cwd=cwd, check=True, capture_output=True, text=True, encoding='utf-8')
-        # Print stdout line by line to handle potential multi-line output better
-        for line in result.stdout.splitlines():
-            print(line)
-        return result.stdout.strip()
-    except subprocess.CalledProcessError as e:
-        print(f"Error running command: {' '.join(original_cmd)}", file=sys.stderr) # Use original cmd in error
-        print(f"Full command attempted: {' '.join(cmd)}", file=sys.stderr)
-        print(f"Return code: {e.returncode}", file=sys.stderr)
-        print(f"Stderr: {e.stderr}", file=sys.stderr)
-        print(f"Stdout: {e.stdout}", file=sys.stderr)
-        return None # Indicate failure
+        result = await run_process(cmd, cwd)
+        if result.returncode != 0:
+            log(f"Error running command: {' '.join(original_cmd)}", file=sys.stderr) # Use original cmd in error
+            log(f"Full command attempted: {' '.join(cmd)}", file=sys.stderr)
+            log(f"Return code: {result.returncode}", file=sys.stderr)
+            log(f"Stderr: {decode_output(result.stderr)}", file=sys.stderr)
+            log(f"Stdout: {decode_output(result.stdout)}", file=sys.stderr)
+            return None # Indicate failure
+        # Decode once, then print line by line to handle potential multi-line output better
+        stdout = decode_output(result.stdout)
+        for line in stdout.splitlines():
+            log(line)
+        return stdout.strip()
     except FileNotFoundError:
-        # This error should now only happen if GIT_EXECUTABLE is wrong
-        print(f"Error: Command '{cmd[0]}' not found. Is the GIT_EXECUTABLE path correct?", file=sys.stderr)
-        print(f"Path used: {GIT_EXECUTABLE}", file=sys.stderr)
-        sys.exit(1) # Exit if Git executable is fundamentally wrong
+        # This error should now only happen if GIT_EXECUTABLE is wrong; abort this repository's reset
+        raise GitNotFoundError(f"Command '{cmd[0]}' not found. Is the GIT_EXECUTABLE path correct?")
     except Exception as e: # Catch other potential errors like encoding issues
-        print(f"An unexpected error occurred running {' '.join(original_cmd)}: {e}", file=sys.stderr)
+        log(f"An unexpected error occurred running {' '.join(original_cmd)}: {e}", file=sys.stderr)
         return None # Indicate failure
 
-def get_main_branch_name(repo_path):
+async def get_main_branch_name(repo_path):
     """Determines the main branch name (main or master)."""
-    # Check for 'main'
-    if run_command(["git", "show-ref", "--verify", "--quiet", "refs/heads/main"], repo_path) is not None:
-        print("Detected main branch: main")
-        return "main"
-    # Check for 'master' if 'main' not found
-    if run_command(["git", "show-ref", "--verify", "--quiet", "refs/heads/master"], repo_path) is not None:
-        print("Detected main branch: master")
-        return "master"
-
-    print("Error: Could not determine main branch (neither 'main' nor 'master' found).", file=sys.stderr)
+    # List both candidates with a single for-each-ref instead of one show-ref per name.
+    # lstrip=2 always yields the bare branch name; refname:short turns into
+    # "heads/main" when a tag or other ref is also called "main".
+    output = await run_command_async(["git", "for-each-ref", "--format=%(refname:lstrip=2)", "refs/heads/main", "refs/heads/master"], repo_path)
+    found = set(output.splitlines()) if output else set()
+    for name in ("main", "master"):
+        if name in found:
+            log(f"Detected main branch: {name}")
+            return name
+
+    log("Error: Could not determine main branch (neither 'main' nor 'master' found).", file=sys.stderr)
     return None
 
-def reset_repository(repo_path):
-    """Resets the Git repository at the given path to a clean state."""
+async def delete_branches(branch_names, repo_path):
+    """Deletes local branches with as few `git branch -D` calls as possible, returning the names that could not be deleted."""
+    failed_deletions = []
+    for batch in batch_arguments(branch_names, MAX_COMMAND_LINE - len(GIT_EXECUTABLE) - len(" branch -D")):
+        cmd = [GIT_EXECUTABLE, "branch", "-D"] + batch
+        log(f"Running in {repo_path}: {' '.join(cmd)}")
+        # Use run_process directly so a non-zero exit can be followed up below
+        try:
+            result = await run_process(cmd, repo_path)
+        except OSError as e:
+            log(f"Error: Could not run git branch -D in {repo_path}: {e}", file=sys.stderr)
+            failed_deletions.extend(batch)
+            continue
+        for line in result.stdout.splitlines():
+            log(decode_output(line))
+        if result.returncode == 0:
+            continue
+
+        log(f"Stderr: {decode_output(result.stderr).strip()}", file=sys.stderr)
+        # git keeps going past a failing branch, so ask which of this batch still exist rather
+        # than parsing (possibly localized) stderr. Those failures (e.g. checked out in another
+        # worktree) are deterministic, so don't retry them.
+        remaining = await list_local_branches(repo_path)
+        failed_deletions.extend(batch if remaining is None else [b for b in batch if b in remaining])
+    return failed_deletions
+
+async def list_local_branches(repo_path):
+    """Returns the set of local branch names, or None if they couldn't be listed."""
+    # lstrip=2 keeps names bare even when a tag shares a branch's name
+    try:
+        result = await run_process([GIT_EXECUTABLE, "for-each-ref", "--format=%(refname:lstrip=2)", "refs/heads/"], repo_path)
+    except OSError as e:
+        log(f"Error: Could not list branches in {repo_path}: {e}", file=sys.stderr)
+        return None
+    if result.returncode != 0:
+        log(f"Error: Could not list branches in {repo_path}. Stderr: {decode_output(result.stderr).strip()}", file=sys.stderr)
+        return None
+    return set(decode_output(result.stdout).splitlines())
+
+def batch_arguments(args, max_length):
+    """Splits args into lists whose joined command-line length stays within max_length."""
+    batch, length = [], 0
+    for arg in args:
+        arg_length = len(arg) + 3 # Separating space plus quotes Windows may add
+        if batch and length + arg_length > max_length:
+            yield batch
+            batch, length = [], 0
+        batch.append(arg)
+        length += arg_length
+    if batch:
+        yield batch
+
+async def fetch_is_fresh(repo_path, main_branch):
+    """Returns True if origin/<main_branch> was fetched within FETCH_TTL seconds and still matches that fetch."""
+    fetch_head = os.path.join(repo_path, ".git", "FETCH_HEAD")
+    try:
+        last_fetch = os.path.getmtime(fetch_head)
+        with open(fetch_head, 'rb') as f:
+            fetch_head_lines = decode_output(f.read()).splitlines()
+    except OSError:
+        return False # Never fetched
+    if time.time() - last_fetch >= FETCH_TTL:
+        return False
+
+    # git rewrites FETCH_HEAD even when a fetch fails (leaving it empty) or fetches some other
+    # ref, so only trust it if it records <main_branch> itself: "<sha>\t[not-for-merge]\tbranch '<main>' of <url>"
+    fetched_sha = None
+    for line in fetch_head_lines:
+        fields = line.split("\t")
+        if len(fields) == 3 and fields[2].startswith(f"branch '{main_branch}' of "):
+            fetched_sha = fields[0]
+            break
+    if fetched_sha is None:
+        return False
+
+    # ...and only if the remote-tracking ref we'd reset to is still what that fetch brought in
+    try:
+        result = await run_process([GIT_EXECUTABLE, "rev-parse", "--verify", "--quiet", f"refs/remotes/origin/{main_branch}"], repo_path)
+    except OSError as e:
+        log(f"Warning: Could not check origin/{main_branch} ({e}). Fetching instead.", file=sys.stderr)
+        return False
+    return result.returncode == 0 and decode_output(result.stdout).strip() == fetched_sha
+
+async def reset_repository(repo_path, shallow=False):
+    """Resets the Git repository at the given path to a clean state. Returns False if the reset was aborted."""
     # Check if the path is a directory and contains .git
     git_dir = os.path.join(repo_path, ".git")
     if not os.path.isdir(repo_path) or not os.path.isdir(git_dir):
-        print(f"'{repo_path}' does not appear to be an initialized Git repository.", file=sys.stderr)
-        return # Don't proceed if it's not a repo
+        log(f"'{repo_path}' does not appear to be an initialized Git repository.", file=sys.stderr)
+        return False # Don't proceed if it's not a repo
 
-    print(f"--- Resetting Git repository: {repo_path} ---")
+    log(f"--- Resetting Git repository: {repo_path} ---")
 
     # 1. Determine main branch
-    main_branch = get_main_branch_name(repo_path)
+    main_branch = await get_main_branch_name(repo_path)
     if not main_branch:
-        print("Aborting reset due to missing main branch.", file=sys.stderr)
-        return
+        log("Aborting reset due to missing main branch.", file=sys.stderr)
+        return False
 
     # 2. Stash any potential leftover changes (useful if reset/clean fail partially)
-    print("Attempting to stash potential leftovers...")
-    # Use subprocess.run directly to handle non-zero exit code gracefully if nothing to stash
-    stash_result = subprocess.run([GIT_EXECUTABLE, "stash", "push", "--include-untracked", "-m", "AutoAgentResetStash"], cwd=repo_path, capture_output=True, text=True, encoding='utf-8')
-    if stash_result.returncode == 0 and "No local changes" not in stash_result.stdout:
-        print("Stashed changes. Dropping stash...")
-        # Use run_command to drop the stash, ensuring errors are caught if drop fails
-        drop_output = run_command(["git", "stash", "drop"], repo_path)
+    log("Attempting to stash potential leftovers...")
+    # Use run_process directly to handle non-zero exit code gracefully if nothing to stash
+    stash_result = await run_process([GIT_EXECUTABLE, "stash", "push", "--include-untracked", "-m", "AutoAgentResetStash"], repo_path)
+    if stash_result.returncode == 0 and b"No local changes" not in stash_result.stdout:
+        log("Stashed changes. Dropping stash...")
+        # Use run_command_async to drop the stash, ensuring errors are caught if drop fails
+        drop_output = await run_command_async(["git", "stash", "drop"], repo_path)
         if drop_output is None:
-            print("Warning: Failed to drop stash. Manual cleanup might be needed ('git stash list').", file=sys.stderr)
+            log("Warning: Failed to drop stash. Manual cleanup might be needed ('git stash list').", file=sys.stderr)
     elif stash_result.returncode != 0:
-         print(f"Stash command failed (may be expected if no changes). Stderr: {stash_result.stderr.strip()}")
+         log(f"Stash command failed (may be expected if no changes). Stderr: {decode_output(stash_result.stderr).strip()}")
     else:
-        print("No local changes to stash.")
+        log("No local changes to stash.")
 
 
     # 3. Checkout main branch
-    print(f"Switching to branch: {main_branch}")
-    if run_command(["git", "checkout", main_branch], repo_path) is None:
-         print(f"Error: Failed to switch to branch {main_branch}. Aborting further potentially destructive actions.", file=sys.stderr)
-         return # Stop if we can't switch
+    log(f"Switching to branch: {main_branch}")
+    if await run_command_async(["git", "checkout", main_branch], repo_path) is None:
+         log(f"Error: Failed to switch to branch {main_branch}. Aborting further potentially destructive actions.", file=sys.stderr)
+         return False # Stop if we can't switch
 
     # Confirm we are on the main branch now
-    current_branch_check = run_command(["git", "branch", "--show-current"], repo_path)
+    current_branch_check = await run_command_async(["git", "branch", "--show-current"], repo_path)
     if current_branch_check != main_branch:
-         print(f"Error: Failed to confirm switch to branch {main_branch} (Current: {current_branch_check}). Aborting.", file=sys.stderr)
-         return
+         log(f"Error: Failed to confirm switch to branch {main_branch} (Current: {current_branch_check}). Aborting.", file=sys.stderr)
+         return False
 
     # 4. Fetch latest changes for the main branch from origin (optional but good practice)
-    print(f"Fetching latest changes for {main_branch}...")
-    if run_command(["git", "fetch", "origin", main_branch], repo_path) is None:
-        print(f"Warning: Failed to fetch origin/{main_branch}. Resetting to local {main_branch}.", file=sys.stderr)
-        reset_target = "HEAD" # Reset to local HEAD if fetch failed
+    if await fetch_is_fresh(repo_path, main_branch):
+        log(f"origin/{main_branch} was fetched less than {FETCH_TTL:g}s ago, skipping fetch.")
+        reset_target = f"origin/{main_branch}"
     else:
-        reset_target = f"origin/{main_branch}" # Reset to origin's version if fetch succeeded
-        print(f"Successfully fetched origin/{main_branch}.")
+        log(f"Fetching latest changes for {main_branch}...")
+        # --depth=1 only when asked for, since it turns a full clone into a shallow one
+        fetch_cmd = ["git", "fetch", "--depth=1", "origin", main_branch] if shallow else ["git", "fetch", "origin", main_branch]
+        if await run_command_async(fetch_cmd, repo_path) is None:
+            log(f"Warning: Failed to fetch origin/{main_branch}. Resetting to local {main_branch}.", file=sys.stderr)
+            reset_target = "HEAD" # Reset to local HEAD if fetch failed
+        else:
+            reset_target = f"origin/{main_branch}" # Reset to origin's version if fetch succeeded
+            log(f"Successfully fetched origin/{main_branch}.")
 
 
     # 5. Force reset to the state of the fetched main branch HEAD (or local if fetch failed)
-    print(f"Resetting index and working directory to {reset_target}...")
-    if run_command(["git", "reset", "--hard", reset_target], repo_path) is None:
-         print(f"Error: Failed hard reset on branch {main_branch} to {reset_target}. State might be inconsistent.", file=sys.stderr)
-         return # Stop if reset failed
+    log(f"Resetting index and working directory to {reset_target}...")
+    if await run_command_async(["git", "reset", "--hard", reset_target], repo_path) is None:
+         log(f"Error: Failed hard reset on branch {main_branch} to {reset_target}. State might be inconsistent.", file=sys.stderr)
+         return False # Stop if reset failed
 
 
     # 6. Remove all untracked files and directories
-    print("Cleaning untracked files...")
+    log("Cleaning untracked files...")
     # -f: force, -d: directories, -x: ignored files too (like .rej, .patch)
-    if run_command(["git", "clean", "-fdx"], repo_path) is None:
-         print(f"Warning: Failed git clean. Untracked files might remain.", file=sys.stderr)
+    if await run_command_async(["git", "clean", "-fdx"], repo_path) is None:
+         log(f"Warning: Failed git clean. Untracked files might remain.", file=sys.stderr)
 
 
     # 7. Delete all local branches except the main one
-    print("Deleting other local branches...")
-    branches_output = run_command(["git", "branch"], repo_path)
+    log("Deleting other local branches...")
+    # for-each-ref has no '* '/'+ ' markers to strip, and lstrip=2 keeps names bare
+    # even when a tag shares a branch's name (refname:short would print "heads/<name>")
+    branches_output = await run_command_async(["git", "for-each-ref", "--format=%(refname:lstrip=2)", "refs/heads/"], repo_path)
     if branches_output:
-        # Filter branches more carefully
-        branches = [b.strip().replace('* ', '') for b in branches_output.splitlines() if b.strip()]
-        deleted_count = 0
-        failed_deletions = []
-        for branch_name in branches:
-            if branch_name != main_branch:
-                print(f"Deleting branch: {branch_name}")
-                if run_command(["git", "branch", "-D", branch_name], repo_path) is not None:
-                    deleted_count += 1
-                else:
-                    # If delete failed, maybe it has upstream tracking? Try without -D
-                    print(f"Force delete failed for {branch_name}, trying regular delete...")
-                    if run_command(["git", "branch", "-d", branch_name], repo_path) is not None:
-                         deleted_count +=1
-                    else:
-                        print(f"Warning: Failed to delete branch {branch_name}", file=sys.stderr)
-                        failed_deletions.append(branch_name)
-
-        print(f"Deleted {deleted_count} other local branches.")
+        branches = branches_output.splitlines()
+        to_delete = [b for b in branches if b != main_branch]
+        failed_deletions = await delete_branches(to_delete, repo_path) if to_delete else []
+        deleted_count = len(to_delete) - len(failed_deletions)
+
+        log(f"Deleted {deleted_count} other local branches.")
         if failed_deletions:
-             print(f"Could not delete branches: {', '.join(failed_deletions)}", file=sys.stderr)
+             log(f"Could not delete branches: {', '.join(failed_deletions)}", file=sys.stderr)
     else:
-         print("Could not list branches or no other branches found.")
+         log("Could not list branches or no other branches found.")
+
+
+    log("--- Repository reset complete ---")
+    return True
 
+async def reset_repositories(repo_paths, max_concurrency=None, shallow=False):
+    """Resets several repositories concurrently; steps within each repository stay sequential.
 
-    print("--- Repository reset complete ---")
+    Returns the paths whose reset was aborted or raised. A failure in one
+    repository is reported and doesn't cancel the resets still running in the others.
+    """
+    if max_concurrency is None:
+        max_concurrency = max(1, min(32, (os.cpu_count() or 1) * 2))
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def reset_one(repo_path):
+        if len(repo_paths) > 1:
+            _log_prefix.set(f"[{repo_path}] ") # Each gathered task runs in its own context copy
+        async with semaphore:
+            try:
+                return await reset_repository(repo_path, shallow)
+            except GitNotFoundError as e:
+                log(f"Error: Reset of {repo_path} aborted: {e}", file=sys.stderr)
+                return False
+            except Exception as e:
+                log(f"Error: Reset of {repo_path} failed: {e!r}", file=sys.stderr)
+                return False
+
+    results = await asyncio.gather(*(reset_one(p) for p in repo_paths))
+    return [p for p, ok in zip(repo_paths, results) if not ok]
+
+def positive_int(value):
+    """argparse type for options that need a whole number of at least 1."""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{value}' is not a whole number")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1 (got {number})")
+    return number
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Reset a Git repository to a clean state on the main branch.")
-    parser.add_argument("repo_path", nargs='?', default="./test_project",
-                        help="Path to the Git repository to reset (default: ./test_project)")
+    targets = parser.add_mutually_exclusive_group()
+    targets.add_argument("repo_path", nargs='?', default="./test_project",
+                         help="Path to the Git repository to reset (default: ./test_project)")
+    targets.add_argument("--repos", nargs='+', metavar="PATH",
+                         help="Reset these repositories concurrently instead of repo_path")
+    parser.add_argument("--jobs", type=positive_int, default=None,
+                        help="Maximum number of repositories reset at once (default: 2x CPU count, capped at 32)")
+    parser.add_argument("--shallow", action="store_true",
+                        help="Fetch only the latest commit of the main branch (git fetch --depth=1)")
     args = parser.parse_args()
 
+    fetch_ttl = os.environ.get("RESET_FETCH_TTL")
+    if fetch_ttl is not None:
+        try:
+            FETCH_TTL = float(fetch_ttl)
+            if not math.isfinite(FETCH_TTL) or FETCH_TTL < 0:
+                raise ValueError(fetch_ttl)
+        except ValueError:
+            print(f"Error: RESET_FETCH_TTL must be a number of seconds (got '{fetch_ttl}').", file=sys.stderr)
+            sys.exit(1)
+
     # Ensure GIT_EXECUTABLE exists before proceeding
     if not os.path.isfile(GIT_EXECUTABLE): # Use isfile for executables
         print(f"FATAL ERROR: Git executable not found at the specified path: {GIT_EXECUTABLE}", file=sys.stderr)
         print("Please correct the GIT_EXECUTABLE variable in the script.", file=sys.stderr)
         sys.exit(1)
 
-    repo_full_path = os.path.abspath(args.repo_path)
+    # --repos resets several repositories concurrently instead of the single positional path.
+    # De-duplicate after resolving symlinks and trailing slashes, so no repository gets two concurrent resets.
+    repo_full_paths = list(dict.fromkeys(os.path.realpath(p) for p in (args.repos or [args.repo_path])))
 
-    # Check if path exists *before* checking if it's a valid directory/repo
-    if not os.path.exists(repo_full_path):
-         print(f"Error: Provided path '{repo_full_path}' does not exist.", file=sys.stderr)
-         sys.exit(1)
-    elif not os.path.isdir(repo_full_path):
-        print(f"Error: Provided path '{repo_full_path}' is not a valid directory.", file=sys.stderr)
-        sys.exit(1)
+    for repo_full_path in repo_full_paths:
+        # Check if path exists *before* checking if it's a valid directory/repo
+        if not os.path.exists(repo_full_path):
+             print(f"Error: Provided path '{repo_full_path}' does not exist.", file=sys.stderr)
+             sys.exit(1)
+        elif not os.path.isdir(repo_full_path):
+            print(f"Error: Provided path '{repo_full_path}' is not a valid directory.", file=sys.stderr)
+            sys.exit(1)
 
-    reset_repository(repo_full_path)
\ No newline at end of file
+    failed_repos = asyncio.run(reset_repositories(repo_full_paths, args.jobs, args.shallow))
+    if failed_repos:
+        print(f"Reset failed for: {', '.join(failed_repos)}", file=sys.stderr)
+        sys.exit(1)